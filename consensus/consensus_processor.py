@@ -16,34 +16,71 @@
 import logging
 logger = logging.getLogger(__name__)
 
-from collections import Counter, defaultdict
+from array import array, typecodes
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from pyroaring import BitMap
 
 # defaults
 MIN_REDUNDANCY = 3
 PASS_THRESHOLD = 2
+# topics run serially unless iaa_config asks for a thread pool
+MAX_WORKERS = 1
+
+# Note that each contributor's highlights are flattened into a bitmap of
+# char position indices. The bitmap union operator is great for this
+# use-case. Summing over contributors produces a numpy array of counts
+# indexed by char position. Case numbers are kept per annotation range
+# rather than per char position.
+# The article text itself is kept as a linear array of chars, since every
+# position is looked up again when setting the consensus text.
 
-# Note that the basic data structures are sets, dicts, and Counters keyed
-# by char position indices. (Not arrays representing the article characters
-# linearly.) The set union and intersection and Counter + operators
-# are great for this use-case.
+# 'u' is deprecated from Python 3.13 in favour of 'w'.
+CHAR_TYPECODE = 'w' if 'w' in typecodes else 'u'
 
 class ArticleData(object):
+    __slots__ = ('article_sha256', 'article_filename', 'buf', 'written',
+                 'text_cache')
+
     def __init__(self):
         self.article_sha256 = None
         self.article_filename = None
-        self.char_dict = {}
+        # chars indexed by position, and a parallel flag per position
+        # recording whether any annotation has supplied that char yet.
+        self.buf = array(CHAR_TYPECODE)
+        self.written = bytearray()
+        # buf as a str, built on first get_text after any consider.
+        self.text_cache = None
 
-    # assume we don't have access to full article - build a map of indices to
-    # chars for every annotation being processed.
+    # assume we don't have access to full article - build an array of
+    # chars covering every annotation being processed.
     def consider(self, anno):
-        anno_range = range(int(anno['start_pos']), int(anno['end_pos']))
-        target_text = anno['target_text'].decode('unicode-escape')
-        anno_map = dict(zip(anno_range, target_text))
-        # belt & suspenders - verify any overlaps are consistent with prior text
-        intersection = self.char_dict.viewkeys() & anno_map.viewkeys()
-        for k in intersection:
-            assert(self.char_dict[k] == anno_map[k])
-        self.char_dict.update(anno_map)
+        start = int(anno['start_pos'])
+        target_text = anno['target_text']
+        # unicode-escape leaves ASCII text without backslashes unchanged,
+        # which covers most highlights - only run the codec when needed.
+        if not target_text.isascii() or '\\' in target_text:
+            # on a str the codec would read the UTF-8 bytes as latin-1, so
+            # turn non-latin-1 chars into escapes the codec restores intact.
+            target_text = target_text.encode('latin-1', 'backslashreplace')
+            target_text = target_text.decode('unicode-escape')
+        # only positions with a char in target_text get filled in
+        end = min(int(anno['end_pos']), start + len(target_text))
+        if end > len(self.buf):
+            grow = end - len(self.buf)
+            self.buf.fromunicode('\0' * grow)
+            self.written.extend(bytearray(grow))
+        anno_text = target_text[:max(end - start, 0)]
+        if self.written.find(b'\x01', start, end) != -1:
+            # belt & suspenders - verify any overlaps are consistent with prior text
+            for pos, char in enumerate(anno_text, start):
+                if self.written[pos]:
+                    assert(self.buf[pos] == char)
+        self.buf[start:end] = array(CHAR_TYPECODE, anno_text)
+        self.written[start:end] = b'\x01' * len(anno_text)
+        self.text_cache = None
         if self.article_sha256 is None:
             self.article_sha256 = anno['article_sha256']
             self.article_filename = anno['article_filename']
@@ -56,34 +93,62 @@ class ArticleData(object):
         row['article_filename'] = self.article_filename
 
     def get(self, char_index):
-        return self.char_dict[char_index]
+        if char_index >= len(self.written) or not self.written[char_index]:
+            raise KeyError(char_index)
+        return self.buf[char_index]
+
+    def get_text(self, start, end):
+        # every position must have been supplied by some annotation -
+        # find() clips end to the buffer, so check past it separately.
+        missing = self.written.find(b'\x00', start, end)
+        if missing == -1 and end > len(self.written):
+            missing = max(start, len(self.written))
+        if missing != -1:
+            raise KeyError(missing)
+        # consensus text is only needed once all annotations are considered,
+        # so convert buf once and slice the str for every offset.
+        if self.text_cache is None:
+            self.text_cache = self.buf.tounicode()
+        return self.text_cache[start:end]
 
 
 class ContribData(object):
+    # one instance per contributor per topic
+    __slots__ = ('flattened', 'case_intervals')
+
     def __init__(self):
-        self.flattened = set()
-        self.case_number_dict = {}
+        self.flattened = BitMap()
+        # (start_pos, end_pos, case_number) for each annotation
+        self.case_intervals = []
 
     def consider(self, anno):
+        self.consider_many([anno])
+
+    def consider_many(self, annos):
+        # case numbers from a user must be disjoint.
+        # But front-end allows annotation overlaps - see get_case_number.
+        intervals = [
+            (int(anno['start_pos']), int(anno['end_pos']), int(anno['case_number']))
+            for anno in annos
+        ]
         # Flatten all of a user's highlights for a given topic into
-        # a single set. Otherwise the user could increase the weight of
+        # a single bitmap. Otherwise the user could increase the weight of
         # their highlights by overlapping them.
-        anno_set = set(range(int(anno['start_pos']), int(anno['end_pos'])))
-        self.flattened |= anno_set
-        # case numbers from a user must be disjoint.
-        # But front-end allows annotation overlaps.
+        add_range = self.flattened.add_range
+        for start, end, case_number in intervals:
+            add_range(start, end)
+        self.case_intervals.extend(intervals)
+
+    def get_case_number(self, char_index):
         # Keep the lowest case number assigned by this contributor.
-        case_number_keys = self.case_number_dict.viewkeys()
-        new_keys = anno_set - case_number_keys
-        overlapped_keys = case_number_keys & anno_set
-        proposed = int(anno['case_number'])
-        new_dict = dict.fromkeys(new_keys, proposed)
-        overlapped_dict = {
-            k: min(self.case_number_dict[k], proposed)
-            for k in overlapped_keys
-        }
-        self.case_number_dict.update(new_dict)
-        self.case_number_dict.update(overlapped_dict)
+        lowest = min(
+            (case_number
+             for start, end, case_number in self.case_intervals
+             if start <= char_index < end),
+            default=None)
+        if lowest is None:
+            raise KeyError(char_index)
+        return lowest
 
 
 class TopicData(object):
@@ -93,38 +158,73 @@ class TopicData(object):
         self.contrib_dict = defaultdict(ContribData)
 
     def consider(self, anno):
-        contrib_uuid = anno['contributor_uuid']
-        contrib_data = self.contrib_dict[contrib_uuid]
-        contrib_data.consider(anno)
-        if not self.topic_name:
-            self.topic_name = anno['topic_name']
-            self.namespace = anno['namespace']
-        else:
-            assert(self.topic_name == anno['topic_name'])
-            assert(self.namespace == anno['namespace'])
+        self.consider_many([anno])
+
+    def consider_many(self, annos):
+        # group by contributor so each contributor's data is looked up once.
+        contrib_annos = defaultdict(list)
+        for anno in annos:
+            contrib_annos[anno['contributor_uuid']].append(anno)
+            if not self.topic_name:
+                self.topic_name = anno['topic_name']
+                self.namespace = anno['namespace']
+            else:
+                assert(self.topic_name == anno['topic_name'])
+                assert(self.namespace == anno['namespace'])
+        for contrib_uuid, contrib_group in contrib_annos.items():
+            self.contrib_dict[contrib_uuid].consider_many(contrib_group)
 
     def sum_contribs(self):
-        topic_counter = Counter()
-        for contrib_uuid, contrib_data in self.contrib_dict.iteritems():
-           # multi-set addition...similar to adding vectors of 0s and 1s.
-           # except just tracking the positions of the 1s.
-           topic_counter += Counter(contrib_data.flattened)
-        return topic_counter
+        # multi-set addition...similar to adding vectors of 0s and 1s.
+        flattened_sets = [
+            contrib_data.flattened
+            for contrib_data in self.contrib_dict.values()
+            if contrib_data.flattened
+        ]
+        size = 0
+        if flattened_sets:
+            size = max(flattened.max() for flattened in flattened_sets) + 1
+        # a position's total can't exceed the number of contributors, so use
+        # the smallest unsigned type that holds it (uint8 below 256).
+        totals = np.zeros(size, dtype=np.min_scalar_type(len(flattened_sets)))
+        for flattened in flattened_sets:
+            # a contributor's positions are distinct, so each gets counted once.
+            totals[np.asarray(flattened.to_array())] += 1
+        return totals
 
     def convert_to_ranges(self, positions):
         offsets = []
         if len(positions) != 0:
-            indices = sorted(positions)
-            start = indices[0]
-            end = start + 1
-            for i,pos in enumerate(indices):
-                if i > 0 and indices[i-1] + 1 != pos:
-                    offsets.append({'start_pos': start, 'end_pos': end})
-                    start = pos
-                end = pos + 1
-            offsets.append({'start_pos': start, 'end_pos': end})
+            # positions may be any sized iterable - a set, dict keys, an array
+            indices = np.fromiter(positions, dtype=np.intp, count=len(positions))
+            indices.sort()
+            # a new range begins wherever a position doesn't directly
+            # follow the one before it.
+            breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+            starts = indices[np.concatenate(([0], breaks))]
+            ends = indices[np.concatenate((breaks - 1, [-1]))] + 1
+            offsets = self.make_offsets(starts, ends)
         return offsets
 
+    def convert_totals_to_ranges(self, totals, pass_threshold):
+        # Same result as convert_to_ranges on the passing positions, but
+        # straight from the totals without materializing those positions:
+        # ranges begin where the padded pass/fail mask steps up and end
+        # where it steps down.
+        # Unhighlighted positions never pass, even for a threshold below 1.
+        passing = np.zeros(len(totals) + 2, dtype=np.int8)
+        passing[1:-1] = totals >= max(pass_threshold, 1)
+        steps = np.diff(passing)
+        starts = np.flatnonzero(steps == 1)
+        ends = np.flatnonzero(steps == -1)
+        return self.make_offsets(starts, ends)
+
+    def make_offsets(self, starts, ends):
+        return [
+            {'start_pos': start, 'end_pos': end}
+            for start, end in zip(starts.tolist(), ends.tolist())
+        ]
+
     def determine_cases(self, offsets):
         rows = []
         for seq, offset in enumerate(offsets):
@@ -135,11 +235,9 @@ class TopicData(object):
             rows.append(row)
         return rows
 
-    def get_consensus(self, determine_passing):
-        topic_counter = self.sum_contribs()
-        passing_tuples = filter(determine_passing, topic_counter.iteritems())
-        passing_indices = dict(passing_tuples).keys()
-        offsets = self.convert_to_ranges(passing_indices)
+    def get_consensus(self, pass_threshold):
+        totals = self.sum_contribs()
+        offsets = self.convert_totals_to_ranges(totals, pass_threshold)
         return offsets
 
     def get_contrib_count(self):
@@ -156,36 +254,55 @@ class ConsensusProcessor(object):
 
     def consider(self, task_highlights):
         minimum_redundancy = self.iaa_config.get('minimum_redundancy', MIN_REDUNDANCY)
+        article_consider = self.article_data.consider
+        # group by topic so each topic's data is looked up once.
+        topic_annos = defaultdict(list)
         for anno in task_highlights:
             if anno['taskrun_count'] < minimum_redundancy:
                 continue
-            self.article_data.consider(anno)
-            topic_name = anno['topic_name']
-            topic_data = self.topics[topic_name]
-            topic_data.consider(anno)
+            article_consider(anno)
+            topic_annos[anno['topic_name']].append(anno)
+        for topic_name, annos in topic_annos.items():
+            self.topics[topic_name].consider_many(annos)
 
     def set_text(self, offsets):
+        get_text = self.article_data.get_text
         for offset in offsets:
-            start = offset['start_pos']
-            end = offset['end_pos']
-            chars = [self.article_data.get(x) for x in range(start, end)]
-            offset['target_text'] = ''.join(chars).encode('unicode-escape')
+            text = get_text(offset['start_pos'], offset['end_pos'])
+            # unicode-escape leaves printable ASCII other than backslash
+            # unchanged, so most text can skip the encode/decode round-trip.
+            if not (text.isascii() and text.isprintable()) or '\\' in text:
+                text = text.encode('unicode-escape').decode('ascii')
+            offset['target_text'] = text
 
     def set_links(self, rows):
         for row in rows:
             self.article_data.set_article_cols(row)
             row['task_uuid'] = self.task_uuid
 
+    def map_topic_consensus(self, pass_threshold):
+        # Each topic's consensus is independent, so topics can run in a
+        # thread pool. Only the numpy parts release the GIL, so any speedup
+        # depends on the data and the machine - it is off by default.
+        # Only read access to article_data happens during this phase.
+        max_workers = self.iaa_config.get('max_workers', MAX_WORKERS)
+        if max_workers is not None and max_workers < 1:
+            raise ValueError(
+                'max_workers must be at least 1, got %r' % (max_workers,))
+        topic_list = list(self.topics.values())
+        thresholds = [pass_threshold] * len(topic_list)
+        if max_workers == 1:
+            offsets_list = list(map(TopicData.get_consensus, topic_list, thresholds))
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                offsets_list = list(executor.map(
+                    TopicData.get_consensus, topic_list, thresholds))
+        return zip(topic_list, offsets_list)
+
     def get_consensus(self):
         consensus_rows = []
-        for topic_name, topic_data in self.topics.iteritems():
-            pass_threshold = self.iaa_config.get('pass_threshold', PASS_THRESHOLD)
-
-            def determine_passing(index_comma_total):
-                (index, total) = index_comma_total
-                return total >= pass_threshold
-
-            offsets = topic_data.get_consensus(determine_passing)
+        pass_threshold = self.iaa_config.get('pass_threshold', PASS_THRESHOLD)
+        for topic_data, offsets in self.map_topic_consensus(pass_threshold):
             self.set_text(offsets)
             rows = topic_data.determine_cases(offsets)
             self.set_links(rows)
@@ -194,14 +311,8 @@ class ConsensusProcessor(object):
 
     def get_answer_consensus(self):
         consensus_rows = []
-        for topic_name, topic_data in self.topics.iteritems():
-            pass_threshold = self.iaa_config.get('pass_threshold', PASS_THRESHOLD)
-
-            def determine_passing(index_comma_total):
-                (index, total) = index_comma_total
-                return total >= pass_threshold
-
-            offsets = topic_data.get_consensus(determine_passing)
+        pass_threshold = self.iaa_config.get('pass_threshold', PASS_THRESHOLD)
+        for topic_data, offsets in self.map_topic_consensus(pass_threshold):
             # Before we give up, return this answer without highlights
             # if it has been chosen more than threshold times, regardless of
             # highlights - which some answers do not even allow.